@@ -1,21 +1,24 @@
-import inspect
-import math
+import heapq
 import os
+import re
+import sys
 import time
+import unicodedata
+import contextlib
 from contextlib import contextmanager
+from contextlib import nullcontext
 from functools import wraps
-import psutil
+from operator import itemgetter
 from django.conf import settings
 from django.db import connection
-from django.db import reset_queries
-from terminaltables import SingleTable
 
 """
 
 Django simple profiler by Sobolev Andrey
 https://github.com/Sobolev5
 
-requires DEBUG=True in settings.py
+requires DEBUG=True in settings.py (checked when a view is decorated)
+only queries on the default database connection are profiled
 
 Example:
 
@@ -63,39 +66,104 @@ def get_countries(request):
 """
 
 
+_USE_COLOR = sys.stdout is not None and sys.stdout.isatty()
+_ANSI_ESCAPE = re.compile(r"\033\[[\d;]+m")
+_CONTEXTMANAGER_ENTER_CODE = contextlib._GeneratorContextManager.__enter__.__code__
+_SQL_TRANSLATION = str.maketrans({'"': None, ",": ", "})
+
+
+# same box characters as terminaltables.SingleTable: code page 437 on Windows, DEC line drawing elsewhere
+_BOX_CHARS = "┌┬┐─│└┴┘" if os.name == "nt" else [f"\033(0{char}\033(B" for char in "lwkqxmvj"]
+(
+    _BOX_TOP_LEFT,
+    _BOX_TOP_INTERSECT,
+    _BOX_TOP_RIGHT,
+    _BOX_HORIZONTAL,
+    _BOX_VERTICAL,
+    _BOX_BOTTOM_LEFT,
+    _BOX_BOTTOM_INTERSECT,
+    _BOX_BOTTOM_RIGHT,
+) = _BOX_CHARS
+
+
+_CELL_WIDTH = 18
+_SIZE_NAMES = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+
+
 def _convert_size(size_bytes):
     if size_bytes == 0:
         return "0B"
-    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-    x = int(math.floor(math.log(size_bytes, 1024)))
-    y = math.pow(1024, x)
-    z = round(size_bytes / y, 2)
-    return "{} {}".format(z, size_name[x])
+    x = min((size_bytes.bit_length() - 1) // 10, len(_SIZE_NAMES) - 1)
+    z = round(size_bytes / (1 << (x * 10)), 2)
+    return "{} {}".format(z, _SIZE_NAMES[x])
+
+
+_PROCESS = None
 
 
 def _get_process_memory():
-    process = psutil.Process(os.getpid())
-    return process.memory_info().rss
+    # psutil is imported lazily so production workers never load it
+    global _PROCESS
+    if _PROCESS is None or _PROCESS.pid != os.getpid():
+        import psutil
+        _PROCESS = psutil.Process()
+    return _PROCESS.memory_info().rss
+
+
+def _visible_width(string):
+    if "\033" in string:
+        string = _ANSI_ESCAPE.sub("", string)
+    return sum(2 if unicodedata.east_asian_width(char) in ("F", "W") else 1 for char in string)
+
+
+def _two_column_table(title, table_data):
+    # fixed two-column layout, drawn directly but identical to a terminaltables SingleTable
+    rows = [(label, _visible_width(label), value, _visible_width(value)) for label, value in table_data]
+    label_width = max(row[1] for row in rows) + 2
+    value_width = max(row[3] for row in rows) + 2
+    title_width = _visible_width(title)
+    if title_width <= label_width:
+        top = title + _BOX_HORIZONTAL * (label_width - title_width) + _BOX_TOP_INTERSECT + _BOX_HORIZONTAL * value_width
+    elif title_width <= label_width + 1 + value_width:
+        top = title + _BOX_HORIZONTAL * (label_width + 1 + value_width - title_width)
+    else:
+        top = _BOX_HORIZONTAL * label_width + _BOX_TOP_INTERSECT + _BOX_HORIZONTAL * value_width
+    lines = [_BOX_TOP_LEFT + top + _BOX_TOP_RIGHT]
+    for label, label_visible_width, value, value_visible_width in rows:
+        lines.append("{} {}{}{} {}{}{}".format(
+            _BOX_VERTICAL,
+            label,
+            " " * (label_width - 1 - label_visible_width),
+            _BOX_VERTICAL,
+            value,
+            " " * (value_width - 1 - value_visible_width),
+            _BOX_VERTICAL,
+        ))
+    lines.append(
+        _BOX_BOTTOM_LEFT + _BOX_HORIZONTAL * label_width + _BOX_BOTTOM_INTERSECT
+        + _BOX_HORIZONTAL * value_width + _BOX_BOTTOM_RIGHT
+    )
+    # merge adjacent line-drawing escapes, as terminaltables' UnixTable does
+    return "\n".join(lines).replace("\033(B\033(0", "")
 
 
 def _table_response_timing(lineno, total_time, total_queries_time, queries_count):
     table_data = [
-        ["Total time:", f"{total_time}s           "],
-        ["Database queries time:", f"{total_queries_time}s          "],
-        ["Queries count:", f"{queries_count}            "],
+        ["Total time:", f"{total_time}s".ljust(_CELL_WIDTH)],
+        ["Database queries time:", f"{total_queries_time}s".ljust(_CELL_WIDTH)],
+        ["Queries count:", f"{queries_count:<{_CELL_WIDTH}}"],
     ]
-    table_instance = SingleTable(table_data, f" {lineno} time ")
-    table_instance.inner_heading_row_border = False
-    return table_instance.table
+    return _two_column_table(f" {lineno} time ", table_data)
 
 
 def _table_response_queries(lineno, queries):
+    from terminaltables import SingleTable
     queries_table = []
     if not queries:
         queries_table.append(["No sql queries"])
     else:
         for query in queries:
-            queries_table.append([query["sql"][:200]])
+            queries_table.append([query])
     table_data = queries_table
     len_queries = len(queries)
     if not queries:
@@ -108,119 +176,110 @@ def _table_response_queries(lineno, queries):
 
 def _single_line_response_queries(lineno, queries):
     len_queries = len(queries)
-    print(f"{lineno} {len_queries} queries:\n")
+    lines = [f"{lineno} {len_queries} queries:\n"]
     for query in queries:
-        print(query["sql"])
+        lines.append(query)
+    return "\n".join(lines)
 
 
 def _table_response_memory(lineno, memory_before, memory_after, memory_difference):
     table_data = [
-        ["Memory before:", f"{_convert_size(memory_before)}           "],
-        ["Memory after:", f"{_convert_size(memory_after)}           "],
-        ["Memory difference:", f"{_convert_size(memory_difference)}         "],
+        ["Memory before:", _convert_size(memory_before).ljust(_CELL_WIDTH)],
+        ["Memory after:", _convert_size(memory_after).ljust(_CELL_WIDTH)],
+        ["Memory difference:", _convert_size(memory_difference).ljust(_CELL_WIDTH)],
     ]
-    table_instance = SingleTable(table_data, f" {lineno} memory ")
-    table_instance.inner_heading_row_border = False
-    return table_instance.table
+    return _two_column_table(f" {lineno} memory ", table_data)
 
 
-def django_profiler(func):
+def _prettify_query(query, max_length=None):
+    prettify_sql = "[{}] {}".format(query["time"], query["sql"].translate(_SQL_TRANSLATION))
+    return f"{prettify_sql}\n"[:max_length]
+
+
+def _profile_result(lineno, time_start, memory_before, full):
+    memory_after = _get_process_memory()
+    queries = connection.queries
+    queries_count = len(queries)
+    timed_queries = [(float(query["time"]), query) for query in queries if query["sql"]]
+    total_queries_time = sum(map(itemgetter(0), timed_queries), 0.0)
+    if full:
+        selected_queries = sorted(timed_queries, key=itemgetter(0), reverse=True)
+        queries_list = [_prettify_query(query) for _, query in selected_queries]
+    else:
+        selected_queries = heapq.nlargest(10, timed_queries, key=itemgetter(0))
+        queries_list = [_prettify_query(query, max_length=200) for _, query in selected_queries]
+    total_request_time = (time.perf_counter_ns() - time_start) / 1e9
+    total_request_time = f"{total_request_time:.4f}"
+    if full:
+        response_queries = _single_line_response_queries(lineno, queries_list)
+    else:
+        response_queries = _table_response_queries(lineno, queries_list)
+    output = "\n".join([
+        "",
+        _table_response_timing(lineno, total_request_time, total_queries_time, queries_count),
+        "",
+        response_queries,
+        "",
+        _table_response_memory(lineno, memory_before, memory_after, memory_after - memory_before),
+        "\n",
+    ])
+    # one write per report keeps output from concurrent requests from interleaving;
+    # like print(), do nothing when there is no stdout (pythonw, services)
+    if sys.stdout is not None:
+        sys.stdout.write(output)
+        sys.stdout.flush()
+
+
+def _profile_function(func, full):
+    if not settings.DEBUG:
+        return func
+
+    current_line_no = func.__code__.co_firstlineno
+    current_function_name = func.__name__
+    lineno = f"{current_function_name} [{current_line_no}]"
+
+    @wraps(func)
     def wrapper(*args, **kwargs):    
-        if settings.DEBUG:
-            current_line_no = func.__code__.co_firstlineno
-            current_function_name = func.__name__
-            lineno = f"{current_function_name} [{current_line_no}]"
-            time_start = time.process_time()
-            memory_before = _get_process_memory()
-            reset_queries()
-            response = func(*args, **kwargs)
-            memory_after = _get_process_memory()
-            total_queries_time = 0.0
-            queries_count = len(connection.queries)
-            queries_list = []
-            for query in connection.queries:
-                if query["sql"]:
-                    prettify_sql = "[{}] {}".format(query["time"], query["sql"].replace('"', "").replace(",", ", "))
-                    total_queries_time += float(query["time"])
-                    queries_list.append({"sql": (f"{prettify_sql}\n"), "time": float(query["time"])})
-            queries_list = sorted(queries_list, key=lambda x: -x["time"])
-            total_request_time = time.process_time() - time_start
-            total_request_time = f"{round(total_request_time, 4)}"
-            print("\n",_table_response_timing(lineno, total_request_time, total_queries_time, queries_count),"\n")
-            print("\n",_table_response_queries(lineno, queries_list[:10]),"\n")
-            print("\n",_table_response_memory(lineno, memory_before, memory_after, memory_after - memory_before),"\n")
-            return response
-
-        else:
-            response = func(*args, **kwargs)
-            return response
+        time_start = time.perf_counter_ns()
+        memory_before = _get_process_memory()
+        connection.queries_log.clear()
+        response = func(*args, **kwargs)
+        _profile_result(lineno, time_start, memory_before, full)
+        return response
 
     return wrapper
 
 
+def django_profiler(func):
+    return _profile_function(func, full=False)
+
+
 def django_profiler_full(func):
-    def wrapper(*args, **kwargs):    
-        if settings.DEBUG:
-            current_line_no = func.__code__.co_firstlineno
-            current_function_name = func.__name__
-            lineno = f"{current_function_name} [{current_line_no}]"
-            time_start = time.process_time()
-            memory_before = _get_process_memory()
-            reset_queries()
-            response = func(*args, **kwargs)
-            memory_after = _get_process_memory()
-            total_queries_time = 0.0
-            queries_count = len(connection.queries)
-            queries_list = []
-            for query in connection.queries:
-                if query["sql"]:
-                    prettify_sql = "[{}] {}".format(query["time"], query["sql"].replace('"', "").replace(",", ", "))
-                    total_queries_time += float(query["time"])
-                    queries_list.append({"sql": (f"{prettify_sql}\n"), "time": float(query["time"])})
-            queries_list = sorted(queries_list, key=lambda x: -x["time"])
-            total_request_time = time.process_time() - time_start
-            total_request_time = f"{round(total_request_time, 4)}"
-            print("\n",_table_response_timing(lineno, total_request_time, total_queries_time, queries_count),"\n")
-            print("\n",_single_line_response_queries(lineno, queries_list),"\n",)
-            print("\n",_table_response_memory(lineno, memory_before, memory_after, memory_after - memory_before),"\n")
-            return response
-
-        else:
-            response = func(*args, **kwargs)
-            return response
+    return _profile_function(func, full=True)
 
-    return wrapper
 
 @contextmanager
-def DjangoProfiler(label=None, full=None):
-    if settings.DEBUG:
+def _django_profiler(label, full):
+    # skip contextlib's __enter__; a cythonized generator has no frame of its own
+    caller = sys._getframe(1)
+    if caller.f_code is _CONTEXTMANAGER_ENTER_CODE:
+        caller = caller.f_back
+    current_line_no = caller.f_lineno
+    current_function_name = caller.f_code.co_name
+
+    if label:
+        lineno = f"\033[1;31m{label}\033[0m [{current_line_no}]" if _USE_COLOR else f"{label} [{current_line_no}]"
+    else:
+        lineno = f"{current_function_name} [{current_line_no}]"
 
-        current_line_no = inspect.stack()[2][2]
-        current_function_name = inspect.stack()[2][3]
+    time_start = time.perf_counter_ns()
+    memory_before = _get_process_memory()
+    connection.queries_log.clear()
+    yield
+    _profile_result(lineno, time_start, memory_before, full)
 
-        if label:
-            lineno = f"\033[1;31m{label}\033[0m [{current_line_no}]"
-        else:
-            lineno = f"{current_function_name} [{current_line_no}]"
 
-        time_start = time.process_time()
-        memory_before = _get_process_memory()
-        reset_queries()
-        yield
-        memory_after = _get_process_memory()
-        total_queries_time = 0.0
-        queries_count = len(connection.queries)
-        queries_list = []
-        for query in connection.queries:
-            if query["sql"]:
-                prettify_sql = "[{}] {}".format(query["time"], query["sql"].replace('"', "").replace(",", ", "))
-                total_queries_time += float(query["time"])
-                queries_list.append({"sql": (f"{prettify_sql}\n"), "time": float(query["time"])})
-        queries_list = sorted(queries_list, key=lambda x: -x["time"])
-        total_request_time = time.process_time() - time_start
-        total_request_time = f"{round(total_request_time, 4)}"
-        print("\n",_table_response_timing(lineno, total_request_time, total_queries_time, queries_count),"\n")
-        print("\n",_single_line_response_queries(lineno, queries_list),"\n") if full else print("\n",_table_response_queries(lineno, queries_list[:10]),"\n")
-        print("\n",_table_response_memory(lineno, memory_before, memory_after, memory_after - memory_before),"\n")
-    else:
-        yield
+def DjangoProfiler(label=None, full=None):
+    if not settings.DEBUG:
+        return nullcontext()
+    return _django_profiler(label, full)
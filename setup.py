@@ -8,10 +8,16 @@ __version__ = '0.5.2'
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
+ext_modules = []
+if os.environ.get("DJANGO_SIMPLE_PROFILER_CYTHON"):
+    from Cython.Build import cythonize
+    ext_modules = cythonize(["django_simple_profiler/functions.py"], language_level=3)
+
 setuptools.setup(
     name='django-simple-profiler',
     version=__version__,
     install_requires=['terminaltables', 'psutil'],
+    ext_modules=ext_modules,
     author='Sobolev Andrey',
     url="https://github.com/Sobolev5/django-simple-profiler",        
     author_email='email.asobolev@gmail.com',
@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("django")
+terminaltables = pytest.importorskip("terminaltables")
+
+from django_simple_profiler.functions import _convert_size
+from django_simple_profiler.functions import _two_column_table
+
+
+@pytest.mark.parametrize(
+    "title, table_data",
+    [
+        (" view [12] time ", [["Total time:", "0.1234s"], ["Database queries time:", "0.05s"], ["Queries count:", "3"]]),
+        (" \033[1;31mLabel\033[0m [5] memory ", [["Memory before:", "1.0 MB"], ["Memory after:", "2.0 MB"]]),
+        (" a_title_wider_than_the_first_column [7] ", [["a:", "b"], ["c:", "d"]]),
+        (" ab ", [["a:", "value"]]),
+        (" ab [1] ", [["a:", "value"]]),
+        (" ab [1] x ", [["a:", "value"]]),
+        (" abc ", [["a:", "value"]]),
+        (" ab [1] xyz ", [["a:", "value"]]),
+        (" a_title_wider_than_the_whole_table_so_it_is_hidden [7] ", [["a:", "b"]]),
+        (" 国家 [3] time ", [["合計時間:", "0.1s"], ["Queries count:", "数"]]),
+    ],
+)
+def test_two_column_table_matches_single_table(title, table_data):
+    table_instance = terminaltables.SingleTable(table_data, title)
+    table_instance.inner_heading_row_border = False
+    assert _two_column_table(title, table_data) == table_instance.table
+
+
+@pytest.mark.parametrize(
+    "size_bytes, expected",
+    [
+        (0, "0B"),
+        (1023, "1023.0 B"),
+        (1024, "1.0 KB"),
+        (1024 ** 2, "1.0 MB"),
+        (-5000, "-4.88 KB"),
+        (2 ** 100, "1048576.0 YB"),
+    ],
+)
+def test_convert_size(size_bytes, expected):
+    assert _convert_size(size_bytes) == expected